@@ -1,8 +1,14 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import altair as alt
-from utils import robust_scan
-from logic import extract_metadata, apply_matching_logic, get_export_filename, process_trend_reports, get_reason_colors, get_trend_suffix, get_apc_performance_data
+from utils import robust_scan, to_csv_bytes, normalize_keys
+from logic import extract_metadata, apply_matching_logic, get_export_filename, get_reason_colors, get_trend_suffix, get_apc_performance_data, normalize_reasons, get_daily_status_counts, build_trend_frame, get_business_dates, get_date_labels, get_right_key_rows
+
+# Copy-on-Write is always on from pandas 3; opt in on 2.x so filtered frames
+# below are views until a column is actually written
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
 st.set_page_config(layout="wide", page_title="CSV Matcher")
 st.title("🛡️ APC Validation")
@@ -21,6 +27,76 @@ right_targets = {
     'Time': ['DATETIME', 'TIME'], 'Equipment': ['EQPNAME', 'EQUIPMENT'], 'Eventlist': ['EVENTLIST', 'EVENT_LIST']
 }
 
+# --- Interface Display (shown once the Left file is loaded) ---
+@st.fragment
+def render_match_view(df_left, df_right, right_key_rows):
+    """
+    Left table, export and the Right lookup panel. Runs as a fragment, so a row
+    click reruns only this view instead of the whole script (uploads, trends).
+    """
+    c1, c2 = st.columns([1, 1])
+    with c1:
+        st.subheader("1. Temptation Data")
+        
+        # Show Chart List code block if available
+        if 'CHARTNAME' in df_left.columns and not df_left['CHARTNAME'].replace('', pd.NA).dropna().empty:
+            unique_charts = sorted(df_left['CHARTNAME'].dropna().unique())
+            formatted_list = ", ".join([f'"{chart}"' for chart in unique_charts])
+            with st.expander("📋 View Chart Name List (String Format)"):
+                st.code(formatted_list, language="text")
+
+        # Export Button
+        # The bool flags viewed as int8 are already the category codes: False -> Missing, True -> Matching
+        match_codes = df_left['Found_in_Right'].to_numpy(dtype=bool).view(np.int8)
+        # Only the exported columns are selected before the status is added; helper columns stay behind
+        export_cols = [c for c in ['ID', 'Time', 'CHARTNAME', 'EQUIP', 'Info'] if c in df_left.columns]
+        df_export = df_left[export_cols].assign(Match_Status=pd.Categorical.from_codes(match_codes, categories=["Missing", "Matching"]))
+        export_filename = get_export_filename(df_export)
+        
+        st.download_button(
+            label=f"📥 Export Report ({export_filename})", 
+            data=to_csv_bytes(df_export[['Match_Status'] + export_cols]), 
+            file_name=export_filename, 
+            mime="text/csv"
+        )
+
+        # Dataframe Selection
+        display_cols = ['Found_in_Right', 'ID', 'Time', 'CHARTNAME', 'EQUIP']
+        selection = st.dataframe(
+            df_left[[c for c in display_cols if c in df_left.columns]], 
+            on_select="rerun", 
+            selection_mode="single-row", 
+            width=1000, 
+            hide_index=True,
+            column_config={
+                "Found_in_Right": st.column_config.CheckboxColumn("MatchFound", disabled=True), 
+                "Time": "Lothold Time"
+            }
+        )
+
+    with c2:
+        st.subheader("2. APC Data (Combined)")
+        if df_right is not None and selection.selection["rows"]:
+            idx = selection.selection["rows"][0]
+            sel_key, sel_display = df_left.iloc[idx]['__key'], df_left.iloc[idx]['ID']
+            st.info(f"Searching Combined Process Data for: **{sel_display}**")
+            
+            # Search logic
+            if '.' in sel_display and 'Eventlist' in df_right.columns:
+                match = df_right[df_right['__eventlist_lower'].str.contains(sel_display.lower(), regex=False)]
+            else:
+                rows = right_key_rows.get(sel_key)
+                match = df_right.iloc[rows] if rows is not None else df_right.iloc[:0]
+            
+            if not match.empty:
+                cols_to_show = ['ID', 'Chart', 'Time', 'Equipment']
+                if 'Eventlist' in match.columns and '.' in sel_display: cols_to_show.append('Eventlist')
+                st.dataframe(match[[c for c in cols_to_show if c in match.columns]], width='stretch', hide_index=True)
+            else:
+                st.warning("❌ No record found in any uploaded Right file.")
+        elif df_right is None:
+            st.info("Upload Right CSV files to see matching records.")
+
 # --- 1. Scan Left File ---
 if left_file:
     df_left, err_l = robust_scan(left_file, "Left", left_targets)
@@ -35,88 +111,37 @@ if left_file:
         if 'EQUIP' not in df_left.columns:
             df_left['EQUIP'] = ""
         # Create a key for the selection logic even if empty
-        df_left['__key'] = df_left['ID'].astype(str).str.upper().str.strip()
+        df_left['__key'] = normalize_keys(df_left['ID'])
 
         # --- 2. Process Right Files (If they exist) ---
         df_right = None
+        right_key_rows = None
         if right_files:
             all_right_dfs = []
             right_errors = []
+            seen_hashes = pd.Index([], dtype='uint64')
             for f in right_files:
                 df_r, err_r = robust_scan(f, f.name, right_targets)
                 if df_r is not None:
-                    all_right_dfs.append(df_r)
+                    # Keep only rows not already seen in this or an earlier Right file
+                    row_hashes = pd.util.hash_pandas_object(df_r, index=False)
+                    is_new = ~(row_hashes.isin(seen_hashes) | row_hashes.duplicated())
+                    seen_hashes = seen_hashes.append(pd.Index(row_hashes[is_new]))
+                    all_right_dfs.append(df_r[is_new.to_numpy()])
                 else:
                     right_errors.append(err_r)
 
             if right_errors:
                 for err in right_errors: st.error(f"❌ Right File Error: {err}")
             elif all_right_dfs:
-                df_right = pd.concat(all_right_dfs, ignore_index=True).drop_duplicates()
+                df_right = pd.concat(all_right_dfs, ignore_index=True)
                 # Run the actual matching logic once both sides exist
                 df_left, df_right = apply_matching_logic(df_left, df_right)
+                # Right row positions per key, built once per set of uploads; row clicks are a dict lookup
+                right_key_rows = get_right_key_rows(tuple(f.file_id for f in right_files), df_right)
                 st.success(f"✅ Loaded: {len(df_left)} rows (Left) vs {len(df_right)} unique rows (Right)")
 
-        # --- 3. Interface Display (Always shows if Left exists) ---
-        c1, c2 = st.columns([1, 1])
-        with c1:
-            st.subheader("1. Temptation Data")
-            
-            # Show Chart List code block if available
-            if 'CHARTNAME' in df_left.columns and not df_left['CHARTNAME'].replace('', pd.NA).dropna().empty:
-                unique_charts = sorted(df_left['CHARTNAME'].dropna().unique())
-                formatted_list = ", ".join([f'"{chart}"' for chart in unique_charts])
-                with st.expander("📋 View Chart Name List (String Format)"):
-                    st.code(formatted_list, language="text")
-
-            # Export Button
-            df_export = df_left.copy()
-            df_export['Match_Status'] = df_export['Found_in_Right'].apply(lambda x: "Matching" if x else "Missing")
-            export_filename = get_export_filename(df_export)
-            export_cols = [c for c in ['Match_Status', 'ID', 'Time', 'CHARTNAME', 'EQUIP', 'Info'] if c in df_export.columns]
-            
-            st.download_button(
-                label=f"📥 Export Report ({export_filename})", 
-                data=df_export[export_cols].to_csv(index=False).encode('utf-8'), 
-                file_name=export_filename, 
-                mime="text/csv"
-            )
-
-            # Dataframe Selection
-            display_cols = ['Found_in_Right', 'ID', 'Time', 'CHARTNAME', 'EQUIP']
-            selection = st.dataframe(
-                df_left[[c for c in display_cols if c in df_left.columns]], 
-                on_select="rerun", 
-                selection_mode="single-row", 
-                width=1000, 
-                hide_index=True,
-                column_config={
-                    "Found_in_Right": st.column_config.CheckboxColumn("MatchFound", disabled=True), 
-                    "Time": "Lothold Time"
-                }
-            )
-
-        with c2:
-            st.subheader("2. APC Data (Combined)")
-            if df_right is not None and selection.selection["rows"]:
-                idx = selection.selection["rows"][0]
-                sel_key, sel_display = df_left.iloc[idx]['__key'], df_left.iloc[idx]['ID']
-                st.info(f"Searching Combined Process Data for: **{sel_display}**")
-                
-                # Search logic
-                if '.' in sel_display and 'Eventlist' in df_right.columns:
-                    match = df_right[df_right['Eventlist'].astype(str).str.contains(sel_display, case=False, regex=False)]
-                else:
-                    match = df_right[df_right['__key'] == sel_key]
-                
-                if not match.empty:
-                    cols_to_show = ['ID', 'Chart', 'Time', 'Equipment']
-                    if 'Eventlist' in match.columns and '.' in sel_display: cols_to_show.append('Eventlist')
-                    st.dataframe(match[[c for c in cols_to_show if c in match.columns]], width='stretch', hide_index=True)
-                else:
-                    st.warning("❌ No record found in any uploaded Right file.")
-            elif df_right is None:
-                st.info("Upload Right CSV files to see matching records.")
+        render_match_view(df_left, df_right, right_key_rows)
     else:
         st.error(f"❌ Left File Error: {err_l}")
 
@@ -144,34 +169,41 @@ trend_files = st.file_uploader(
 )
 
 if trend_files:
-    all_reports, failed_files = process_trend_reports(trend_files)
+    # Loading and concatenation are cached together on the upload ids, so reruns
+    # neither re-read the reports nor unpickle them file by file
+    full_df, failed_files = build_trend_frame(tuple(f.file_id for f in trend_files), trend_files)
     if failed_files:
         st.warning("⚠️ The following files were skipped:")
         st.dataframe(pd.DataFrame(failed_files), hide_index=True)
             
-    if all_reports:
-        full_df = pd.concat(all_reports)
-        full_df['DT'] = pd.to_datetime(full_df['Time'], format='%Y%m%d %H%M%S', errors='coerce')
-        full_df.loc[full_df['DT'].isna(), 'DT'] = pd.to_datetime(full_df.loc[full_df['DT'].isna(), 'Time'], errors='coerce')
-        valid_df = full_df.dropna(subset=['DT']).copy()
+    if full_df is not None:
+        # full_df is only read from here on (total counts below)
+        valid_df = full_df[full_df['DT'].notna()]
         
         if not valid_df.empty:
-            valid_df['Business_Date'] = (valid_df['DT'] - pd.Timedelta(hours=7)).dt.normalize()
+            valid_df['Business_Date'] = get_business_dates(valid_df['DT'])
             trend_suffix = get_trend_suffix(valid_df)
+            # Axis labels are formatted once per distinct day and looked up by the charts below
+            date_label_map = get_date_labels(valid_df['Business_Date'])
+            # Chart frames are kept in date order; the x axis follows data order (sort=None)
+            date_label_dtype = pd.CategoricalDtype(date_label_map.unique(), ordered=True)
             
             # --- Chart 1: Daily Matching ---
             st.subheader("1. Daily Matching vs Missing (%)")
-            daily_counts = valid_df.groupby(['Business_Date', 'Match_Status']).size().unstack(fill_value=0)
-            for col in ['Matching', 'Missing', 'Update needed']:
-                if col not in daily_counts.columns: daily_counts[col] = 0
-            
-            total = daily_counts['Matching'] + daily_counts['Missing'] + daily_counts['Update needed']
-            chart_data = (daily_counts[['Missing', 'Update needed', 'Matching']].div(total, axis=0) * 100).reset_index()
-            chart_data['Date_Label'] = chart_data['Business_Date'].dt.strftime('%b %d')
-            chart_data = chart_data.melt(['Business_Date', 'Date_Label'], var_name='Status', value_name='Percentage')
+            status_order = ['Missing', 'Update needed', 'Matching']
+            daily_counts = get_daily_status_counts(valid_df).reindex(columns=status_order, fill_value=0)
+            # All three percentages in one matrix divide over the day totals
+            counts = daily_counts.to_numpy(dtype=float)
+            pcts = counts / counts.sum(axis=1, keepdims=True) * 100
+            # Only the encoded fields are sent with the chart (no Business_Date column)
+            chart_data = pd.DataFrame(pcts, columns=status_order)
+            chart_data['Date_Label'] = daily_counts.index.map(date_label_map)
+            chart_data = chart_data.melt('Date_Label', var_name='Status', value_name='Percentage')
+            # Streamlit ships chart data as Arrow; categorical labels go over as dictionary-encoded codes
+            chart_data = chart_data.astype({'Date_Label': date_label_dtype, 'Status': 'category'})
             
             chart1 = alt.Chart(chart_data).mark_bar().encode(
-                x=alt.X('Date_Label:O', sort=alt.EncodingSortField(field="Business_Date", op="min"), title='Date', axis=alt.Axis(labelAngle=0)),
+                x=alt.X('Date_Label:O', sort=None, title='Date', axis=alt.Axis(labelAngle=0)),
                 y=alt.Y('Percentage:Q', scale=alt.Scale(domain=[0, 100])),
                 color=alt.Color('Status', scale=alt.Scale(domain=['Missing', 'Update needed', 'Matching'], range=['#FF7601', '#FCB53B', '#00809D'])),
                 tooltip=['Date_Label', 'Status', alt.Tooltip('Percentage', format='.1f')]
@@ -183,13 +215,14 @@ if trend_files:
             if 'Reason' in valid_df.columns:
                 st.divider()
                 st.subheader("2. Missing Reasons Analysis")
-                missing_df = valid_df[valid_df['Match_Status'].isin(['Missing', 'Update needed'])].copy()
+                missing_df = valid_df[valid_df['Match_Status'].isin(['Missing', 'Update needed'])]
                 # Identify all possible dates across the entire dataset to show empty columns
-                all_dates = sorted(valid_df['Business_Date'].unique())
+                all_dates = date_label_map.index
                 if not missing_df.empty:
                     # Clean and normalize Reasons
-                    missing_df['Reason'] = missing_df['Reason'].fillna("Unknown").astype(str).str.strip().str.capitalize().replace({'Nan': 'Unknown', 'None': 'Unknown', '': 'Unknown'})
-                    unique_reasons = sorted(missing_df['Reason'].unique().tolist())
+                    missing_df['Reason'] = normalize_reasons(missing_df['Reason'])
+                    # Present reasons come from the category codes; only the few labels are sorted
+                    unique_reasons = sorted(missing_df['Reason'].cat.remove_unused_categories().cat.categories)
                 else:
                     unique_reasons = ["No Missing Items"]
 
@@ -199,7 +232,7 @@ if trend_files:
 
                 # Merge with actual counts if they exist; otherwise initialize 'Count' to 0
                 if not missing_df.empty:
-                    actual_counts = missing_df.groupby(['Business_Date', 'Reason']).size().reset_index(name='Count')
+                    actual_counts = missing_df.groupby(['Business_Date', 'Reason'], observed=True, sort=False).size().reset_index(name='Count')
                     reason_counts = pd.merge(reason_counts, actual_counts, on=['Business_Date', 'Reason'], how='left')
                 else:
                     # Fix for KeyError: 'Count' when no data is missing
@@ -207,11 +240,13 @@ if trend_files:
                 
                 # Safely fill missing combinations (or existing 0s)
                 reason_counts['Count'] = reason_counts['Count'].fillna(0)
-                reason_counts['Date_Label'] = reason_counts['Business_Date'].dt.strftime('%b %d')
+                reason_counts['Date_Label'] = reason_counts['Business_Date'].map(date_label_map)
+                # Business_Date was only needed for the merge; the chart encodes Date_Label
+                reason_counts = reason_counts.drop(columns='Business_Date').astype({'Date_Label': date_label_dtype, 'Reason': 'category'})
                 
                 # Generate chart with restored red/pink color logic from logic.py
                 chart2 = alt.Chart(reason_counts).mark_bar().encode(
-                    x=alt.X('Date_Label:O', sort=alt.EncodingSortField(field="Business_Date", op="min"), title='Date', axis=alt.Axis(labelAngle=0)),
+                    x=alt.X('Date_Label:O', sort=None, title='Date', axis=alt.Axis(labelAngle=0)),
                     y=alt.Y('Count:Q'),
                     color=alt.Color('Reason', title='Reason', scale=alt.Scale(domain=unique_reasons, range=get_reason_colors(unique_reasons))), 
                     tooltip=['Date_Label', 'Reason', 'Count']
@@ -226,9 +261,10 @@ if trend_files:
                 st.info("Percentage of 'Time is more accurate in APC'")
                 perf_data = get_apc_performance_data(valid_df)
                 if not perf_data.empty:
-                    chart3 = alt.Chart(perf_data).mark_bar().encode(
+                    # Only the encoded fields are sent with the chart
+                    chart3 = alt.Chart(perf_data[['Date_Label', 'Performance %', 'Total_Matching']]).mark_bar().encode(
                         x=alt.X('Date_Label:O', 
-                                sort=alt.EncodingSortField(field="Business_Date", op="min"), 
+                                sort=None, 
 								title='Date'),
 						y=alt.Y('Performance %:Q', 
 								scale=alt.Scale(domain=[0, 100]), 
@@ -276,7 +312,7 @@ if trend_files:
                     )
 
                 # --- Apply Combined Filtering Logic ---
-                filtered_display_df = valid_df.copy()
+                filtered_display_df = valid_df
                 
                 if selected_statuses:
                     filtered_display_df = filtered_display_df[filtered_display_df['Match_Status'].isin(selected_statuses)]
@@ -305,7 +341,7 @@ if trend_files:
                     # 3. Pass the sliced dataframe to the download button
                     st.download_button(
                         label=f"📥 Export Current View ({export_filename})",
-                        data=filtered_display_df[available_export_cols].to_csv(index=False).encode('utf-8'),
+                        data=to_csv_bytes(filtered_display_df[available_export_cols]),
                         file_name=export_filename,
                         mime="text/csv"
                     )
@@ -330,7 +366,7 @@ if trend_files:
                 
                 # 1. Calculation logic (Same as before)
                 total_cases = len(full_df)
-                status_counts = full_df['Match_Status'].value_counts()
+                status_counts = full_df['Match_Status'].value_counts(sort=False)
                 
                 m_count = status_counts.get('Matching', 0)
                 u_count = status_counts.get('Update needed', 0)
@@ -359,7 +395,7 @@ if trend_files:
                 
                 st.download_button(
                     label="📥 Export Weekly Summary (CSV)",
-                    data=summary_df.to_csv(index=False).encode('utf-8'),
+                    data=to_csv_bytes(summary_df),
                     file_name=f"weekly_summary_{date_range_label}.csv",
                     mime="text/csv"
                 )
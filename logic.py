@@ -1,20 +1,36 @@
+import csv
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import numpy as np
 import streamlit as st
+from utils import hash_frame, map_distinct, normalize_keys
 # logic.py
 
+# Rows per chunk when streaming daily reports, to keep peak memory bounded
+TREND_CHUNKSIZE = 200_000
+# Upper bound on threads parsing daily reports in parallel
+TREND_WORKERS = 8
+# Columns used downstream by the trend charts, tables and exports
+TREND_COLUMNS = ['Match_Status', 'Reason', 'Time', 'CHARTNAME', 'ID', 'EQUIP', 'Info']
+# Info-column rules (see extract_metadata)
+CHART_PATTERN = re.compile(r'SMCchart\s+(.+?)\s+-\s+Lot')
+EQUIP_PATTERN = re.compile(r'Equipment\s+([A-Za-z0-9]+#\d+)')
+
 def extract_metadata(df_left):
     """
     Extracts CHARTNAME and EQUIP from the 'Info' column immediately.
     """
     # Rule: CHARTNAME is between 'SMCchart' and '- Lot'
-    df_left['CHARTNAME'] = df_left['Info'].astype(str).str.extract(r'SMCchart\s+(.+?)\s+-\s+Lot', expand=False).str.lower()
+    df_left['CHARTNAME'] = df_left['Info'].str.extract(CHART_PATTERN, expand=False).str.lower()
     
     # Rule: EQUIP is after 'Equipment', format 'Name#Digits'
-    df_left['EQUIP'] = df_left['Info'].astype(str).str.extract(r'Equipment\s+([A-Za-z0-9]+#\d+)', expand=False)
+    df_left['EQUIP'] = df_left['Info'].str.extract(EQUIP_PATTERN, expand=False)
     
     # Normalize ID for matching later
-    df_left['__key'] = df_left['ID'].astype(str).str.upper().str.strip()
-    df_left['__chart_clean'] = df_left['CHARTNAME'].fillna('').str.strip().str.upper()
+    df_left['__key'] = normalize_keys(df_left['ID'])
+    df_left['__chart_clean'] = normalize_keys(df_left['CHARTNAME'].fillna(''))
     
     return df_left
 
@@ -22,47 +38,74 @@ def apply_matching_logic(df_left, df_right):
     """
     Performs LotID and Chart Name matching once Right data is available.
     """
+    df_left, df_right, special_count = _cached_matching(df_left, df_right)
+    if special_count:
+        st.toast(f"ℹ️ detected {special_count} complex IDs with dots. Scanning Eventlists...")
+    return df_left, df_right
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={pd.DataFrame: hash_frame})
+def _cached_matching(df_left, df_right):
+    """
+    Cached matching core. Returns the matched frames plus the number of
+    ChildLot IDs that had to be searched in the Eventlists.
+    """
     # 1. Standard Normalization (Right side only now, Left is done in extract_metadata)
-    df_right['__key'] = df_right['ID'].astype(str).str.upper().str.strip()
+    df_right['__key'] = normalize_keys(df_right['ID'])
     
     if 'Chart' in df_right.columns:
-        df_right['__chart_clean'] = df_right['Chart'].astype(str).replace('nan', '').fillna('').str.strip().str.upper()
+        df_right['__chart_clean'] = normalize_keys(df_right['Chart'].replace('nan', '').fillna(''))
     else:
         df_right['__chart_clean'] = ""
 
+    # Lower-cased Eventlist for the row-click search
+    if 'Eventlist' in df_right.columns:
+        df_right['__eventlist_lower'] = df_right['Eventlist'].str.lower()
+
     # Create Composite Keys
-    df_left['__composite_key'] = df_left['__key'] + "|" + df_left['__chart_clean']
-    df_right['__composite_key'] = df_right['__key'] + "|" + df_right['__chart_clean']
+    # Key and chart are each factorized over Left and Right together, so the
+    # (key, chart) pair becomes one shared integer code and no strings are built per row
+    n_left = len(df_left)
+    key_codes, _ = pd.factorize(pd.concat([df_left['__key'], df_right['__key']], ignore_index=True))
+    chart_codes, chart_uniques = pd.factorize(pd.concat([df_left['__chart_clean'], df_right['__chart_clean']], ignore_index=True))
+    composite_codes = key_codes.astype(np.int64) * len(chart_uniques) + chart_codes
     
     # 2. Strict Exact Match Check
-    df_left['Found_in_Right'] = df_left['__composite_key'].isin(df_right['__composite_key'])
+    df_left['Found_in_Right'] = np.isin(composite_codes[:n_left], composite_codes[n_left:])
 
     # 3. --- SPECIAL ChildLot RULE ---
-    mask_special = (~df_left['Found_in_Right']) & (df_left['ID'].astype(str).str.contains('.', regex=False))
+    mask_special = (~df_left['Found_in_Right']) & (df_left['ID'].str.contains('.', regex=False))
     
+    special_count = 0
     if mask_special.any() and 'Eventlist' in df_right.columns:
-        st.toast(f"ℹ️ detected {mask_special.sum()} complex IDs with dots. Scanning Eventlists...")
-        right_eventlist_series = df_right['Eventlist'].astype(str)
-        
-        for idx in df_left[mask_special].index:
-            search_val = df_left.at[idx, 'ID']
-            is_found = right_eventlist_series.str.contains(search_val, case=False, regex=False).any()
-            if is_found:
-                df_left.at[idx, 'Found_in_Right'] = True                
-    return df_left, df_right
+        special_count = int(mask_special.sum())
+        # Distinct Eventlists joined into one text; one substring search per ChildLot ID
+        eventlist_text = '\x00'.join(df_right['__eventlist_lower'].dropna().unique())
+        special_ids = df_left.loc[mask_special, 'ID']
+        found = {search_val: search_val.lower() in eventlist_text for search_val in special_ids.unique()}
+        df_left.loc[mask_special, 'Found_in_Right'] = special_ids.map(found).astype(bool)
+    return df_left, df_right, special_count
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_right_key_rows(right_files_key, _df_right):
+    """
+    Maps each Right __key to its row positions for the row-click lookup.
+    Kept as a shared resource keyed on the upload ids, so the frame isn't rehashed.
+    """
+    return _df_right.groupby('__key', sort=False).indices
 
 def get_export_filename(df_export):
     """Generates a filename based on the business date found in the data."""
     export_filename = "matching_report.csv"
     try:
-        temp_dates = pd.to_datetime(df_export['Time'], format='%Y%m%d %H%M%S', errors='coerce')
-        if temp_dates.isna().sum() > (len(temp_dates) * 0.5): 
-             temp_dates = pd.to_datetime(df_export['Time'], errors='coerce')
+        temp_dates = parse_report_times(df_export['Time'])
         
         business_dates = temp_dates - pd.Timedelta(hours=7) + pd.Timedelta(days=1)
         
-        if not business_dates.dropna().empty:
-            top_date = business_dates.mode()[0]
+        business_dates = business_dates.dropna()
+        if not business_dates.empty:
+            # Most frequent date; uniques are sorted, so ties go to the earliest
+            codes, uniques = pd.factorize(business_dates, sort=True)
+            top_date = uniques[np.bincount(codes).argmax()]
             date_suffix = top_date.strftime('%m%d')
             export_filename = f"matching_report_{date_suffix}.csv"
     except Exception as e:
@@ -73,7 +116,33 @@ def process_trend_reports(trend_files):
     """Consolidates multiple reports and prepares data for trending."""
     all_reports = []
     failed_files = []
-    
+    if not trend_files:
+        return all_reports, failed_files
+
+    # Uploads are read on the script thread; the parsing runs in worker threads,
+    # since the C parser releases the GIL while tokenizing. map() keeps file order.
+    payloads = []
+    for file in trend_files:
+        file.seek(0)
+        payloads.append(file.getvalue() if hasattr(file, 'getvalue') else file.read())
+    with ThreadPoolExecutor(max_workers=min(TREND_WORKERS, len(payloads))) as pool:
+        results = list(pool.map(_load_trend_file, payloads))
+
+    for file, (file_chunks, error) in zip(trend_files, results):
+        if file_chunks is None:
+            failed_files.append({'File': file.name, 'Reason': error})
+            continue
+        all_reports.extend(file_chunks)
+            
+    return all_reports, failed_files
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _load_trend_file(file_bytes):
+    """
+    Parses and normalizes one daily report. Cached on the file contents, so
+    adding a report to the upload set doesn't re-read the ones already loaded.
+    Returns (chunks, None) on success or (None, reason) on failure.
+    """
     rename_map = {
         'NEW COMMENT': 'Reason', 'New_Comments': 'Reason', 'new comments': 'Reason',
         'New Comments': 'Reason', 'new comment': 'Reason', 'new_comment': 'Reason',
@@ -81,30 +150,96 @@ def process_trend_reports(trend_files):
         'Comments': 'Match_Status', 'LOT_HOLD_TIME': 'Time'
     }
 
-    for file in trend_files:
-        try:
-            df_temp = pd.read_csv(file, sep=None, engine='python')
-            if 'Match_Status' not in df_temp.columns or 'Time' not in df_temp.columns:
-                file.seek(0)
-                df_temp = pd.read_csv(file, sep=';')
-
-            df_temp.columns = df_temp.columns.str.strip()
-            df_temp.rename(columns=rename_map, inplace=True)
-            
-            required_check = ['Match_Status', 'Time']
-            if not all(col in df_temp.columns for col in required_check):
-                failed_files.append({'File': file.name, 'Reason': "Missing required columns"})
-                continue
-          
-            df_temp['Match_Status'] = df_temp['Match_Status'].astype(str).str.title().str.strip()
-            df_temp['Match_Status'] = df_temp['Match_Status'].replace({
-                'Update Needed': 'Update needed', 'Matching': 'Matching', 'Missing': 'Missing'
-            })
-            all_reports.append(df_temp)
-        except Exception as e:
-            failed_files.append({'File': file.name, 'Reason': str(e)})
-            
-    return all_reports, failed_files
+    try:
+        file = io.BytesIO(file_bytes)
+        # Sniff the delimiter from the header line, then stream the file through the C parser
+        header_line = file.readline().decode('utf-8-sig', errors='replace')
+        sep = csv.Sniffer().sniff(header_line).delimiter
+        header = pd.read_csv(io.StringIO(header_line), sep=sep, nrows=0).columns
+        if 'Match_Status' not in header or 'Time' not in header:
+            sep = ';'
+
+        # Normalize each chunk and keep only the columns the trend section uses
+        file_chunks = []
+        file.seek(0)
+        # Everything is read as text: no per-chunk type inference, and chunks of one
+        # file can't disagree on a column's dtype (e.g. int vs float once NaNs appear)
+        with pd.read_csv(file, sep=sep, engine='c', dtype=str, chunksize=TREND_CHUNKSIZE) as reader:
+            for chunk in reader:
+                chunk.columns = chunk.columns.str.strip()
+                chunk.rename(columns=rename_map, inplace=True)
+
+                required_check = ['Match_Status', 'Time']
+                if not all(col in chunk.columns for col in required_check):
+                    return None, "Missing required columns"
+
+                chunk['Match_Status'] = normalize_statuses(chunk['Match_Status'])
+                file_chunks.append(chunk[[c for c in TREND_COLUMNS if c in chunk.columns]])
+        return file_chunks, None
+    except Exception as e:
+        return None, str(e)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_trend_frame(reports_key, _trend_files):
+    """
+    Loads the daily reports, concatenates them, parses their times and casts
+    the status columns to category. Cached on the upload ids (reports_key), so
+    reruns from the filters and downloads don't touch the reports at all.
+    Returns (full_df, failed_files); full_df is None when no report loaded.
+    """
+    all_reports, failed_files = process_trend_reports(_trend_files)
+    if not all_reports:
+        return None, failed_files
+
+    full_df = pd.concat(all_reports, ignore_index=True)
+    full_df['DT'] = parse_report_times(full_df['Time'])
+    # Categorical status/reason columns let the groupbys and the overall
+    # status totals work on integer codes
+    full_df['Match_Status'] = full_df['Match_Status'].astype('category')
+    if 'Reason' in full_df.columns:
+        full_df['Reason'] = full_df['Reason'].astype('category')
+    return full_df, failed_files
+
+def normalize_statuses(statuses):
+    """Title-cases and strips Match_Status values ('update needed' -> 'Update needed')."""
+    def title_strip(uniques):
+        clean = pd.Index(uniques.astype(str)).str.title().str.strip()
+        return clean.where(clean != 'Update Needed', 'Update needed')
+    return map_distinct(statuses, title_strip)
+
+def parse_report_times(times):
+    """
+    Parses report timestamps. The native '%Y%m%d %H%M%S' format is handled in
+    one fixed-format pass; only rows that fail it go through format inference.
+    """
+    parsed = pd.to_datetime(times, format='%Y%m%d %H%M%S', errors='coerce')
+    failed = parsed.isna() & times.notna()
+    if failed.any():
+        parsed = parsed.where(~failed, pd.to_datetime(times[failed], errors='coerce'))
+    return parsed
+
+def get_business_dates(times):
+    """
+    Buckets report timestamps into business days, which start at 07:00.
+    Shifts and floors the int64 ticks to whole days.
+    """
+    values = times.to_numpy()
+    if values.dtype.kind != 'M':
+        # tz-aware or object input: fall back to the datetime accessor
+        return (times - pd.Timedelta(hours=7)).dt.normalize()
+    unit = np.datetime_data(values.dtype)[0]
+    day = np.timedelta64(1, 'D').astype(f'm8[{unit}]').astype(np.int64)
+    offset = np.timedelta64(7, 'h').astype(f'm8[{unit}]').astype(np.int64)
+    ticks = values.view(np.int64) - offset
+    return pd.Series((ticks // day * day).view(values.dtype), index=times.index)
+
+def get_date_labels(dates):
+    """
+    Maps each distinct business date to its '%b %d' axis label, in date order.
+    strftime runs once per day; the charts look their labels up in the result.
+    """
+    unique_dates = dates.drop_duplicates().sort_values()
+    return pd.Series(unique_dates.dt.strftime('%b %d').to_numpy(), index=unique_dates.to_numpy())
 
 def get_trend_suffix(valid_df):
     """Generates the suffix used for trend chart export filenames."""
@@ -115,45 +250,80 @@ def get_trend_suffix(valid_df):
     except:
         return "history"
 
+def get_daily_status_counts(valid_df):
+    """
+    Counts records per Business_Date x Match_Status with one np.bincount
+    over the flattened (date, status) cell codes.
+    """
+    statuses = valid_df['Match_Status'].cat
+    n_statuses = len(statuses.categories)
+    # Rows without a status (code -1) are not counted
+    status_codes = statuses.codes.to_numpy()
+    has_status = status_codes >= 0
+    date_codes, dates = pd.factorize(valid_df['Business_Date'][has_status], sort=True)
+
+    cell_codes = date_codes * n_statuses + status_codes[has_status]
+    counts = np.bincount(cell_codes, minlength=len(dates) * n_statuses).reshape(len(dates), n_statuses)
+    return pd.DataFrame(counts, index=pd.Index(dates, name='Business_Date'), columns=pd.Index(statuses.categories, name='Match_Status'))
+
+def normalize_reasons(reasons):
+    """
+    Cleans a categorical Reason column for the missing-reasons chart.
+    Strip/capitalize and the Unknown mapping run once per distinct category,
+    then every row is remapped with a single gather over the category codes.
+    """
+    clean = reasons.cat.categories.astype(str).str.strip().str.capitalize()
+    clean = clean.where(~clean.isin(['Nan', 'None', '']), 'Unknown')
+    clean_cats = clean.append(pd.Index(['Unknown'])).unique()
+
+    # Old code -> new code; the extra last slot catches NaN rows (code -1)
+    lookup = np.append(clean_cats.get_indexer(clean), clean_cats.get_loc('Unknown'))
+    codes = lookup[reasons.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=clean_cats), index=reasons.index, name=reasons.name)
+
 def get_reason_colors(unique_reasons):
     """Generates the specific color mapping for missing reasons."""
-    color_range = []
     safe_palette = ['#2ca02c', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
-    palette_idx = 0
-    
-    for r in unique_reasons:
-        r_lower = r.lower()
-        if r_lower == "missing":
-            color_range.append('#d62728') 
-        elif "missing in apc but present in trend" in r_lower:
-            color_range.append('#ff9896') 
-        elif "chart status not correct" in r_lower:
-            color_range.append('#1f77b4')
-        elif "missing due to a virtual parameter" in r_lower:
-            color_range.append('#ff7f0e')
-        else:
-            color_range.append(safe_palette[palette_idx % len(safe_palette)])
-            palette_idx += 1
-    return color_range
+    r_lower = pd.Index(unique_reasons, dtype=object).str.lower()
+
+    # First matching rule wins; everything else cycles through the safe palette in order
+    color_range = np.select(
+        [
+            r_lower == "missing",
+            r_lower.str.contains("missing in apc but present in trend", regex=False),
+            r_lower.str.contains("chart status not correct", regex=False),
+            r_lower.str.contains("missing due to a virtual parameter", regex=False),
+        ],
+        ['#d62728', '#ff9896', '#1f77b4', '#ff7f0e'],
+        default='',
+    ).astype(object)
+    other = color_range == ''
+    color_range[other] = np.take(safe_palette, np.arange(other.sum()), mode='wrap')
+    return color_range.tolist()
 
 def get_apc_performance_data(valid_df):
-    # 1. Find all Matching data
-    matching_df = valid_df[valid_df['Match_Status'] == 'Matching'].copy()
+    # 1. Find all Matching data (only the columns used below)
+    matching_df = valid_df.loc[valid_df['Match_Status'] == 'Matching', ['Business_Date', 'Reason']]
     
     if matching_df.empty:
         return pd.DataFrame()
 
     # 2. Find "more accurate in APC" from Reason
-    target_reason = "Time is more accurate in APC"
-    matching_df['is_accurate_time'] = matching_df['Reason'].astype(str).str.contains(
-        "time is more accurate in APC", case=False, na=False
-    )
+    # Reason is categorical, so the text test runs once per distinct reason and is
+    # broadcast through the codes; the trailing False catches missing reasons (code -1)
+    reasons = matching_df['Reason'].cat
+    is_accurate = reasons.categories.astype(str).str.contains("time is more accurate in APC", case=False)
+    is_accurate_time = np.append(is_accurate, False)[reasons.codes.to_numpy()].astype(np.int8)
 
     # 3. group by Business_Date and calculate counts for total Matching and accurate time cases
-    perf_stats = matching_df.groupby('Business_Date').agg(
-        Total_Matching=('Match_Status', 'count'),
-        Accurate_Time_Count=('is_accurate_time', 'sum')
-    ).reset_index()
+    # One groupby over the int8 flags: size gives the Matching total, sum the accurate cases
+    perf_stats = (
+        pd.Series(is_accurate_time, index=matching_df.index)
+        .groupby(matching_df['Business_Date'])
+        .agg(['size', 'sum'])
+        .rename(columns={'size': 'Total_Matching', 'sum': 'Accurate_Time_Count'})
+        .reset_index()
+    )
 
     # 4. calculate performance percentage
     perf_stats['Performance %'] = (perf_stats['Accurate_Time_Count'] / perf_stats['Total_Matching']) * 100
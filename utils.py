@@ -1,74 +1,205 @@
+import csv
+import functools
+import io
+import re
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import streamlit as st
+
+# Lines searched for the header row
+HEADER_SCAN_LINES = 50
+# Rows per chunk when reading the data rows below the header
+SCAN_CHUNKSIZE = 250_000
+# Bytes per block when counting the fields of each line
+SCAN_BLOCK_BYTES = 1 << 24
 
 def robust_scan(file, file_label, target_cols):
     """
-    Scans a file line-by-line looking for specific column headers.
+    Cached entry point for scanning an uploaded file.
+    Streamlit reruns the whole script on every interaction, so the parse is
+    keyed on the file contents and only redone when a new file is uploaded.
+    """
+    file.seek(0)
+    file_bytes = file.getvalue() if hasattr(file, 'getvalue') else file.read()
+    if isinstance(file_bytes, str):
+        file_bytes = file_bytes.encode('latin1', errors='replace')
+    # Dicts are not hashable, so the targets are frozen into nested tuples
+    target_cols_tuple = tuple((key, tuple(terms)) for key, terms in target_cols.items())
+    return _cached_robust_scan(file_bytes, file_label, target_cols_tuple)
+
+# The Left file and every Right file share this cache, so the cap sits well above
+# a realistic upload count; a lower one lets the uploads evict each other
+@st.cache_data(show_spinner=False, max_entries=64)
+def _cached_robust_scan(file_bytes, file_label, target_cols_tuple):
+    return _scan_file(io.BytesIO(file_bytes), file_label, target_cols_tuple)
+
+@functools.lru_cache(maxsize=64)
+def _match_header_line(clean_line, target_cols_tuple):
+    """
+    Checks one upper-cased candidate line for the ID column and maps the
+    target columns to their positions. Returns (delimiter, col_indices), or
+    None when the line is not a header. Cached per distinct header line, since
+    files exported by the same tool share the same header.
+    """
+    target_cols = dict(target_cols_tuple)
+    id_terms = target_cols['ID']
+
+    # --- Improved Delimiter Detection ---
+    # Semicolon wins when both would validate. A delimiter that doesn't occur
+    # in the line can't give more than one part, so it is never split on.
+    # A plain split, like the quote-blind parse of the data rows.
+    for delimiter in (';', ','):
+        if delimiter not in clean_line: continue
+        parts = [p.strip() for p in clean_line.split(delimiter)]
+        if any(term in part for part in parts for term in id_terms):
+            break
+    else:
+        return None
+
+    col_indices = {
+        key: next((idx for idx, part in enumerate(parts) if any(term in part for term in search_terms)), -1)
+        for key, search_terms in target_cols.items()
+    }
+    return delimiter, col_indices
+
+def _scan_file(file, file_label, target_cols_tuple):
+    """
+    Scans the first lines of a file looking for specific column headers,
+    then reads the data rows below it with pandas.read_csv.
     Auto-detects whether the separator is a comma (,) or semicolon (;).
     """
+    target_cols = dict(target_cols_tuple)
     file.seek(0)
-    lines = []
-    for line in file.readlines():
-        if isinstance(line, bytes):
-            lines.append(line.decode('latin1', errors='ignore'))
-        else:
-            lines.append(line)
-            
+
     # A. Detect Header Row & Column Indices
-    header_index = -1
-    col_indices = {key: -1 for key in target_cols} 
-    found_header = False
-    delimiter = ',' # Default fallback
-    
-    # Scan first 50 lines to find a header row that contains our main ID
-    for i, line in enumerate(lines[:50]):
-        clean_line = line.strip()
-        if not clean_line: continue
-        
-        # --- Improved Delimiter Detection ---
-        parts_comma = [p.strip().upper() for p in clean_line.split(',')]
-        valid_comma = len(parts_comma) > 1 and any(term in part for part in parts_comma for term in target_cols['ID'])
-        
-        parts_semi = [p.strip().upper() for p in clean_line.split(';')]
-        valid_semi = len(parts_semi) > 1 and any(term in part for part in parts_semi for term in target_cols['ID'])
-        
-        parts = []
-        if valid_semi:
-            delimiter = ';'
-            parts = parts_semi
-            found_header = True
-        elif valid_comma:
-            delimiter = ','
-            parts = parts_comma
-            found_header = True
-            
-        if found_header:
-            header_index = i
-            for idx, part in enumerate(parts):
-                for key, search_terms in target_cols.items():
-                    if col_indices[key] == -1:
-                        if any(term in part for term in search_terms):
-                            col_indices[key] = idx
+    # Lines without any ID term are rejected with one regex search
+    id_pat = re.compile('|'.join(re.escape(term) for term in target_cols['ID']))
+
+    # Scan first 50 lines to find a header row that contains our main ID.
+    # Lines are read one at a time, so nothing past the header is decoded here.
+    header = None
+    for header_index in range(HEADER_SCAN_LINES):
+        line = file.readline()
+        if not line: break
+        if isinstance(line, bytes):
+            line = line.decode('latin1', errors='ignore')
+        clean_line = line.strip().upper()
+        if not clean_line or not id_pat.search(clean_line): continue
+        header = _match_header_line(clean_line, target_cols_tuple)
+        if header is not None:
             break
-            
-    if not found_header:
+
+    if header is None:
         return None, f"Could not find a Header row containing 'LOT' (or delimiters were not detected) in {file_label} file."
+    delimiter, col_indices = header
 
     # B. Extract Data
-    data = []
-    for line in lines[header_index+1:]:
-        parts = line.split(delimiter)
-        if len(parts) < 2: continue
-
-        row_data = {}
-        max_needed = max(col_indices.values())
-        
-        if len(parts) > max_needed:
-            for key, idx in col_indices.items():
-                if idx != -1:
-                    val = parts[idx].strip().replace('"', '').replace("'", "")
-                    row_data[key] = val
-                else:
-                    row_data[key] = "N/A"
-            data.append(row_data)
-
-    return pd.DataFrame(data), None
\ No newline at end of file
+    # Map the positional header indices back to our logical column names
+    found_cols = {idx: key for key, idx in col_indices.items() if idx != -1}
+    # Lines too short to reach every target column (or with a single field) are
+    # skipped. The parse is quote-blind with '\n' line ends, like the field count,
+    # so parser rows are file lines; _strip_quotes removes the quotes afterwards.
+    field_counts = _line_field_counts(file.getbuffer(), delimiter)
+    short_lines = np.flatnonzero(field_counts[header_index + 1:] < max(max(found_cols) + 1, 2)) + header_index + 1
+    skip_lines = set(range(header_index + 1)).union(short_lines.tolist())
+    file.seek(0)
+    chunks = []
+    try:
+        with pd.read_csv(
+            file, sep=delimiter, header=None, skiprows=skip_lines,
+            names=range(max(found_cols) + 1), usecols=list(found_cols), index_col=False,
+            dtype='string[pyarrow]', encoding='latin1', engine='c', na_filter=False,
+            quoting=csv.QUOTE_NONE, lineterminator='\n', skip_blank_lines=False,
+            chunksize=SCAN_CHUNKSIZE
+        ) as reader:
+            for chunk in reader:
+                chunk = chunk.rename(columns=found_cols)
+                for key in found_cols.values():
+                    chunk[key] = _strip_quotes(chunk[key])
+
+                # Drop footer/garbage lines that carry nothing beyond their first field
+                if len(found_cols) > 1:
+                    chunk = chunk[chunk.iloc[:, 1:].ne('').any(axis=1)]
+                chunks.append(chunk)
+    except pd.errors.EmptyDataError:
+        pass
+    except (pd.errors.ParserError, ValueError) as e:
+        return None, f"{file_label} file could not be parsed: {e}"
+
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=list(found_cols.values()), dtype='string[pyarrow]')
+
+    for key in target_cols:
+        if key not in df.columns:
+            df[key] = "N/A"
+
+    return df[list(target_cols)].reset_index(drop=True), None
+
+def _line_field_counts(data, delimiter):
+    """
+    Counts the delimiter-separated fields of every '\n'-terminated line in a
+    byte buffer. Line ends and delimiters are located with numpy, block by block,
+    so no Python object is built per line.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    def positions(byte):
+        return np.concatenate([np.empty(0, np.intp)] + [
+            np.flatnonzero(data[i:i + SCAN_BLOCK_BYTES] == byte) + i
+            for i in range(0, len(data), SCAN_BLOCK_BYTES)
+        ])
+
+    line_ends = positions(ord('\n'))
+    if len(data) and data[-1] != ord('\n'):
+        line_ends = np.append(line_ends, len(data))
+    # Delimiters before each line end, differenced into per-line counts
+    delimiters_before = np.searchsorted(positions(ord(delimiter)), line_ends)
+    return np.diff(delimiters_before, prepend=0) + 1
+
+def _strip_quotes(values):
+    """Removes quote characters and surrounding whitespace with literal Arrow kernels (no regex)."""
+    arr = pa.array(values)
+    arr = pc.replace_substring(pc.replace_substring(arr, '"', ''), "'", '')
+    return pd.Series(pd.arrays.ArrowStringArray(pc.utf8_trim_whitespace(arr)), index=values.index)
+
+def map_distinct(values, transform):
+    """
+    Applies transform to the distinct values only and broadcasts the result back
+    through the factorized codes, since uploads repeat the same lots, charts and
+    statuses on many rows. transform gets the uniques and returns an array-like.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return pd.Series(transform(uniques).take(codes), index=values.index)
+
+def normalize_keys(values):
+    """Upper-cases and strips key values (IDs, chart names) for matching."""
+    def upper_strip(uniques):
+        # Chained Arrow kernels over one Arrow array of the distinct values
+        arr = pa.array(np.asarray(uniques.astype(str), dtype=object), type=pa.string(), from_pandas=True)
+        return pd.arrays.ArrowStringArray(pc.utf8_trim_whitespace(pc.utf8_upper(arr)))
+    return map_distinct(values, upper_strip)
+
+def hash_frame(df):
+    """Hashes the full frame contents for st.cache_data; Streamlit only samples rows of large frames by default."""
+    return tuple(df.columns), pd.util.hash_pandas_object(df).to_numpy().tobytes()
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs={pd.DataFrame: hash_frame})
+def to_csv_bytes(df):
+    """Encodes a frame as CSV for a download button, cached so reruns don't re-serialize it."""
+    # Text frames go through Arrow's C++ writer. Frames with numbers keep pandas'
+    # number formatting (47.0, True), as do object columns Arrow can't type.
+    text_only = all(dtype == object or isinstance(dtype, (pd.StringDtype, pd.CategoricalDtype)) for dtype in df.dtypes)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False) if text_only else None
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        table = None
+    if table is None:
+        return df.to_csv(index=False).encode('utf-8')
+    buf = io.BytesIO()
+    pa_csv.write_csv(table, buf)
+    return buf.getvalue()